@@ -2,12 +2,15 @@
 # The ElegooNeptuneThumbnails plugin is released under the terms of the AGPLv3 or higher.
 
 import argparse
-import base64
-import math
+import os
+import shutil
 import sys
+import tempfile
 from argparse import Namespace
 from array import array
+from dataclasses import dataclass
 from os import path
+from typing import TextIO
 
 from PyQt6.QtCore import Qt, QByteArray, QBuffer, QIODeviceBase
 from PyQt6.QtGui import QImage, QPainter, QFont, QColor
@@ -16,19 +19,22 @@ from PyQt6.QtWidgets import QApplication
 import lib_col_pic
 
 
+@dataclass(frozen=True, slots=True)
 class SliceData:
     """
     Result data from slicing
     """
 
-    def __init__(self, time_seconds: int, printer_model: str, model_height: float, filament_grams: float,
-                 filament_cost: float, currency: str = None):
-        self.printer_model: str = printer_model
-        self.time_seconds: int = time_seconds
-        self.model_height: float = model_height
-        self.filament_grams: float = filament_grams
-        self.filament_cost: float = filament_cost
-        self.currency: str = currency if currency else "€"
+    time_seconds: int
+    printer_model: str
+    model_height: float
+    filament_grams: float
+    filament_cost: float
+    currency: str = None
+
+    def __post_init__(self):
+        if not self.currency:
+            object.__setattr__(self, "currency", "€")
 
 
 class ElegooNeptuneThumbnails:
@@ -37,6 +43,9 @@ class ElegooNeptuneThumbnails:
     """
 
     KLIPPER_THUMBNAIL_BLOCK_SIZE: int = 78
+    PRINTER_THUMBNAIL_LINE_SIZE: int = 1024 - 8 - 1
+    GCODE_CHUNK_SIZE: int = 1 << 20
+    JPEG_QUALITY: int = 60
     COLORS: dict[str, QColor] = {
         "green": QColor(34, 236, 128),
         "red": QColor(209, 76, 81),
@@ -64,10 +73,16 @@ class ElegooNeptuneThumbnails:
         self._gcode: str = args.gcode
         self._printer_model: str = args.printer
         self._currency: str = args.currency
-        self._thumbnail: QImage = self._get_q_image_thumbnail()
+
+        # Read thumbnail and slice data in a single pass over the gcode
+        base64_thumbnail, attributes = self._read_gcode(min_size=300)
+        self._thumbnail: QImage = self._get_q_image_thumbnail(base64_thumbnail)
 
         # Get slice data
-        self._slice_data: SliceData = self._get_slice_data()
+        self._slice_data: SliceData = self._get_slice_data(attributes)
+
+        # Option lines only depend on the slice data, so they are shared by all generated thumbnails
+        self._option_lines: list[str] = self._generate_option_lines(self._slice_data)
 
         # Find printer model from gcode if not set
         if not self._printer_model or self._printer_model not in (
@@ -92,48 +107,9 @@ class ElegooNeptuneThumbnails:
         parser.add_argument("gcode", help="Gcode path provided by OrcaSlicer", type=str)
         return parser.parse_args()
 
-    def _get_base64_thumbnail(self, min_size: int = 300) -> str:
+    def _read_gcode(self, min_size: int = 300) -> tuple[bytearray, dict[str, str]]:
         """
-        Read the base64 encoded thumbnail from gcode file
-        """
-        # Try to find thumbnail
-        found: bool = False
-        base64_thumbnail: str = ""
-        with open(self._gcode, "r", encoding="utf8") as file:
-            for line in file.read().splitlines():
-                if not found and line.startswith("; thumbnail begin "):
-                    parts: list[str] = line.split(" ")
-                    parts_two: list[str] = []
-                    for part in [p.split("x") for p in parts]:
-                        parts_two += part
-                    width, height = map(int, parts_two[3:5])
-                    if width >= min_size and height >= min_size:
-                        found = True
-                elif found and line == "; thumbnail end":
-                    return base64_thumbnail
-                elif found:
-                    base64_thumbnail += line[2:]
-
-        # If not found, raise exception
-        raise Exception(
-            f"Correct size thumbnail is not present: Make sure, that your slicer generates a thumbnail with a size of at least {min_size}x{min_size}")
-
-    def _get_q_image_thumbnail(self) -> QImage:
-        """
-        Read the base64 encoded thumbnail from gcode file and parse it to a QImage object
-        """
-        # Read thumbnail
-        base64_thumbnail: str = self._get_base64_thumbnail(min_size=300)
-
-        # Parse thumbnail
-        thumbnail = QImage()
-        thumbnail.loadFromData(base64.decodebytes(bytes(base64_thumbnail, "UTF-8")), "PNG")
-        thumbnail = thumbnail.scaled(600, 600, Qt.AspectRatioMode.KeepAspectRatio)
-        return thumbnail
-
-    def _get_slice_data(self) -> SliceData:
-        """
-        Read slice data from gcode file
+        Read the base64 encoded thumbnail and the raw slice data attributes from gcode file
         """
         # Mapping of data to extract
         attribute_mapping: dict[str, str] = {
@@ -154,16 +130,57 @@ class ElegooNeptuneThumbnails:
         # Dict to store extracted data
         attributes: dict[str, str] = {}
 
-        # Try to find all attributes
-        with open(self._gcode, "r", encoding="utf8") as file:  # TODO: Optimize search
-            for line in file.read().splitlines():
-                if line.startswith("; "):
-                    for attribute in list(attribute_mapping.keys()):
-                        prefix = f"; {attribute}"
-                        if line.startswith(prefix):
-                            attributes[attribute_mapping[attribute]] = line[len(prefix):]
-                            del attribute_mapping[attribute]
+        # Try to find thumbnail and all attributes
+        found: bool = False
+        thumbnail_data: bytearray = bytearray()
+        base64_thumbnail: bytearray | None = None
+        with open(self._gcode, "r", encoding="utf8") as file:
+            for line in file:
+                if not line.startswith("; "):
+                    continue
+                line = line.rstrip("\n")
+                if base64_thumbnail is None:
+                    if not found and line.startswith("; thumbnail begin "):
+                        parts: list[str] = line.split(" ")
+                        parts_two: list[str] = []
+                        for part in [p.split("x") for p in parts]:
+                            parts_two += part
+                        width, height = map(int, parts_two[3:5])
+                        if width >= min_size and height >= min_size:
+                            found = True
+                        continue
+                    elif found and line == "; thumbnail end":
+                        base64_thumbnail = thumbnail_data
+                        continue
+                    elif found:
+                        thumbnail_data += line[2:].encode("ascii")
+                        continue
+                for attribute in list(attribute_mapping.keys()):
+                    prefix = f"; {attribute}"
+                    if line.startswith(prefix):
+                        attributes[attribute_mapping[attribute]] = line[len(prefix):]
+                        del attribute_mapping[attribute]
 
+        # If not found, raise exception
+        if base64_thumbnail is None:
+            raise Exception(
+                f"Correct size thumbnail is not present: Make sure, that your slicer generates a thumbnail with a size of at least {min_size}x{min_size}")
+        return base64_thumbnail, attributes
+
+    def _get_q_image_thumbnail(self, base64_thumbnail: bytearray) -> QImage:
+        """
+        Parse the base64 encoded thumbnail to a QImage object
+        """
+        # Parse thumbnail
+        thumbnail = QImage()
+        thumbnail.loadFromData(QByteArray.fromBase64(QByteArray(base64_thumbnail)), "PNG")
+        thumbnail = thumbnail.scaled(600, 600, Qt.AspectRatioMode.KeepAspectRatio)
+        return thumbnail
+
+    def _get_slice_data(self, attributes: dict[str, str]) -> SliceData:
+        """
+        Parse slice data from the attributes read from gcode file
+        """
         # Parse extracted data
         time: str = attributes.get("time", None)
         time_seconds: int = -1
@@ -221,49 +238,55 @@ class ElegooNeptuneThumbnails:
         """
         return self._printer_model in self.B64JPG_MODELS
 
-    def _add_thumbnail_metadata(self, is_light_background: bool = False, bg_image_path: str = None) -> QImage:
+    @classmethod
+    def _generate_option_lines(cls, slice_data: SliceData) -> list[str]:
         """
-        Add metadata and background to thumbnail and return
+        Generate the metadata option lines shown in the thumbnail corners
         """
-        # Prepare background
-        background: QImage = QImage(900, 900, QImage.Format.Format_RGBA8888)
-        if bg_image_path is not None:
-            painter = QPainter(background)
-            painter.drawImage(0, 0, QImage(bg_image_path))
-            painter.end()
-
-        # Paint foreground on background
-        painter = QPainter(background)
-        painter.drawImage(150, 160, self._thumbnail)
-        painter.end()
-
-        # Generate option lines
         lines: list[str] = []
 
         # Add print time
-        if self._slice_data.time_seconds < 0:
+        if slice_data.time_seconds < 0:
             lines.append(f"⧖ N/A")
         else:
-            time_minutes: int = math.floor(self._slice_data.time_seconds / 60)
-            lines.append(f"⧖ {time_minutes // 60}:{time_minutes % 60:02d}h")
+            hours, minutes = divmod(slice_data.time_seconds // 60, 60)
+            lines.append(f"⧖ {hours}:{minutes:02d}h")
 
         # Add model height
-        if self._slice_data.model_height < 0:
+        if slice_data.model_height < 0:
             lines.append(f"⭱ N/A")
         else:
-            lines.append(f"⭱ {round(self._slice_data.model_height, 2)}mm")
+            lines.append(f"⭱ {round(slice_data.model_height, 2)}mm")
 
         # Add filament grams
-        if self._slice_data.filament_grams < 0:
+        if slice_data.filament_grams < 0:
             lines.append(f"⭗ N/A")
         else:
-            lines.append(f"⭗ {round(self._slice_data.filament_grams)}g")
+            lines.append(f"⭗ {round(slice_data.filament_grams)}g")
 
         # Add filament cost
-        if self._slice_data.filament_cost < 0:
+        if slice_data.filament_cost < 0:
             lines.append(f"⛁ N/A")
         else:
-            lines.append(f"⛁ {round(self._slice_data.filament_cost, 2):.02f}{self._slice_data.currency}")
+            lines.append(f"⛁ {round(slice_data.filament_cost, 2):.02f}{slice_data.currency}")
+
+        return lines
+
+    def _add_thumbnail_metadata(self, is_light_background: bool = False, bg_image_path: str = None) -> QImage:
+        """
+        Add metadata and background to thumbnail and return
+        """
+        # Prepare background
+        background: QImage = QImage(900, 900, QImage.Format.Format_RGBA8888)
+        if bg_image_path is not None:
+            painter = QPainter(background)
+            painter.drawImage(0, 0, QImage(bg_image_path))
+            painter.end()
+
+        # Paint foreground on background
+        painter = QPainter(background)
+        painter.drawImage(150, 160, self._thumbnail)
+        painter.end()
 
         # Add options
         app = QApplication(sys.argv)  # Trick to make QT not crash on painter.drawText (it needs a QApplication)
@@ -274,7 +297,7 @@ class ElegooNeptuneThumbnails:
             painter.setPen(self.COLORS["darker_gray"])
         else:
             painter.setPen(self.COLORS["own_gray"])
-        for i, line in enumerate(lines):
+        for i, line in enumerate(self._option_lines):
             if line:
                 left: bool = i % 2 == 0
                 top: bool = i < 2
@@ -326,128 +349,136 @@ class ElegooNeptuneThumbnails:
         """
         Adds thumbnail prefix to the gcode file if thumbnail doesn't already exist
         """
-        # Get gcode
-        g_code: str
-        with open(self._gcode, "r", encoding="utf8") as file:
-            g_code: str = file.read()
-
-        # Censor original slicer
-        g_code = g_code.replace("PrusaSlicer", "CensoredSlicer")
-        g_code = g_code.replace("OrcaSlicer", "CensoredSlicer")
-
-        # Disable original thumbnail
-        g_code = g_code.replace("; thumbnail begin ", "; orig_thumbnail begin ")
+        # Resolve symlinks so the linked gcode file gets rewritten
+        gcode_path: str = path.realpath(self._gcode)
+        with open(gcode_path, "r", encoding="utf8") as src:
+            # The prefix is always written to the start of the file, so checking the first chunk is enough
+            g_code: str = self._read_gcode_chunk(src)
+            if ';gimage:' in g_code or ';simage:' in g_code:
+                return
+
+        # Add prefix and copy the gcode chunk by chunk into a temporary file, which then replaces the gcode file
+        gcode_prefix: str = self._generate_gcode_prefix()
+        tmp_fd, tmp_gcode = tempfile.mkstemp(suffix=".tmp", dir=path.dirname(gcode_path))
+        try:
+            with os.fdopen(tmp_fd, "w", encoding="utf8") as dest, open(gcode_path, "r", encoding="utf8") as src:
+                dest.write(gcode_prefix)
+                while g_code := self._read_gcode_chunk(src):
+                    # Censor original slicer
+                    g_code = g_code.replace("PrusaSlicer", "CensoredSlicer")
+                    g_code = g_code.replace("OrcaSlicer", "CensoredSlicer")
+
+                    # Disable original thumbnail
+                    g_code = g_code.replace("; thumbnail begin ", "; orig_thumbnail begin ")
+
+                    dest.write(g_code)
+            shutil.copymode(gcode_path, tmp_gcode)
+            os.replace(tmp_gcode, gcode_path)
+        except BaseException:
+            os.remove(tmp_gcode)
+            raise
 
-        # Add prefix
-        if ';gimage:' not in g_code and ';simage:' not in g_code:
-            gcode_prefix: str = self._generate_gcode_prefix()
-            with open(self._gcode, "w", encoding="utf8") as file:
-                file.write(gcode_prefix + g_code)
+    @classmethod
+    def _read_gcode_chunk(cls, file: TextIO) -> str:
+        """
+        Read the next chunk of gcode, extended to the end of the current line so no replaced text is split
+        """
+        return file.read(cls.GCODE_CHUNK_SIZE) + file.readline()
 
     @classmethod
     def _parse_thumbnails_klipper(cls, small_icon: QImage, big_icon: QImage) -> str:
         """
         Generate klipper thumbnail gcode for thumbnails in sizes 32x32 and 300x300
         """
-        g_code: str = "\r"
+        g_code: list[str] = ["\r"]
         for icon in [small_icon.scaled(32, 32), big_icon.scaled(300, 300)]:
             byte_array: QByteArray = QByteArray()
             byte_buffer: QBuffer = QBuffer(byte_array)
             byte_buffer.open(QIODeviceBase.OpenModeFlag.WriteOnly)
             icon.save(byte_buffer, "PNG")
             base64_string: str = str(byte_array.toBase64().data(), "UTF-8")
-            g_code += f"; thumbnail begin {icon.width()} {icon.height()} {len(base64_string)}\r"
-            while base64_string:
-                g_code += f"; {base64_string[0:cls.KLIPPER_THUMBNAIL_BLOCK_SIZE]}\r"
-                base64_string = base64_string[cls.KLIPPER_THUMBNAIL_BLOCK_SIZE:]
-            g_code += "; thumbnail end\r\r"
-        return g_code
+            g_code.append(f"; thumbnail begin {icon.width()} {icon.height()} {len(base64_string)}\r")
+            for i in range(0, len(base64_string), cls.KLIPPER_THUMBNAIL_BLOCK_SIZE):
+                g_code.append(f"; {base64_string[i:i + cls.KLIPPER_THUMBNAIL_BLOCK_SIZE]}\r")
+            g_code.append("; thumbnail end\r\r")
+        return "".join(g_code)
+
+    @classmethod
+    def _get_rgb565_pixels(cls, img: QImage) -> array:
+        """
+        Convert a QImage to an array of RGB565 pixel values, line by line
+        """
+        rgb565_image: QImage = img.convertToFormat(QImage.Format.Format_RGB16)
+        line_size: int = rgb565_image.width() * 2
+        pixels = array('H')
+        for y in range(rgb565_image.height()):
+            # Lines are padded to 32 bit, so only read the pixels of each line
+            line = rgb565_image.constScanLine(y)
+            line.setsize(line_size)
+            pixels.frombytes(line)
+        return pixels
+
+    @classmethod
+    def _split_image_lines(cls, data: str, img_type: str, layout_len: int = None) -> str:
+        """
+        Split encoded image data into printer lines, each starting with the image type
+        The last line is determined from layout_len, which defaults to the data length
+        """
+        each_max = cls.PRINTER_THUMBNAIL_LINE_SIZE
+        if layout_len is None:
+            layout_len = len(data)
+        last_line_start = layout_len - layout_len % each_max
+        lines: list[str] = []
+        for i in range(0, len(data), each_max):
+            if i == last_line_start:
+                prefix = '\r;' + img_type
+            elif i == 0:
+                prefix = img_type
+            else:
+                prefix = '\r' + img_type
+            lines.append(prefix + data[i:i + each_max])
+        return ''.join(lines)
 
     @classmethod
     def _parse_thumbnail_old(cls, img: QImage, width: int, height: int, img_type: str) -> str:
         """
         Parse thumbnail to string for old printers
-        TODO: Maybe optimize at some time
         """
         img_type = f";{img_type}:"
-        result = ""
         b_image = img.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio)
-        img_size = b_image.size()
-        result += img_type
-        datasize = 0
-        for i in range(img_size.height()):
-            for j in range(img_size.width()):
-                pixel_color = b_image.pixelColor(j, i)
-                r = pixel_color.red() >> 3
-                g = pixel_color.green() >> 2
-                b = pixel_color.blue() >> 3
-                rgb = (r << 11) | (g << 5) | b
-                str_hex = "%x" % rgb
-                if len(str_hex) == 3:
-                    str_hex = '0' + str_hex[0:3]
-                elif len(str_hex) == 2:
-                    str_hex = '00' + str_hex[0:2]
-                elif len(str_hex) == 1:
-                    str_hex = '000' + str_hex[0:1]
-                if str_hex[2:4] != '':
-                    result += str_hex[2:4]
-                    datasize += 2
-                if str_hex[0:2] != '':
-                    result += str_hex[0:2]
-                    datasize += 2
-                if datasize >= 50:
-                    datasize = 0
-            # if i != img_size.height() - 1:
-            result += '\rM10086 ;'
-            if i == img_size.height() - 1:
-                result += "\r"
-        return result
+
+        # Each pixel is written as 4 hex chars, low byte first
+        rgb565: array = cls._get_rgb565_pixels(b_image)
+        if sys.byteorder == "big":
+            rgb565.byteswap()
+        hex_data: str = rgb565.tobytes().hex()
+        row_len: int = b_image.width() * 4
+        rows: list[str] = [hex_data[i:i + row_len] for i in range(0, len(hex_data), row_len)]
+        return img_type + "\rM10086 ;".join(rows) + "\rM10086 ;\r"
 
     @classmethod
     def _parse_thumbnail_new(cls, img: QImage, width: int, height: int, img_type: str) -> str:
         """
         Parse thumbnail to string for new printers
-        TODO: Maybe optimize at some time
         """
         img_type = f";{img_type}:"
 
-        result = ""
         b_image = img.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio)
         img_size = b_image.size()
-        color16 = array('H')
         try:
-            for i in range(img_size.height()):
-                for j in range(img_size.width()):
-                    pixel_color = b_image.pixelColor(j, i)
-                    r = pixel_color.red() >> 3
-                    g = pixel_color.green() >> 2
-                    b = pixel_color.blue() >> 3
-                    rgb = (r << 11) | (g << 5) | b
-                    color16.append(rgb)
-            output_data = bytearray(img_size.height() * img_size.width() * 10)
-            result_int = lib_col_pic.ColPic_EncodeStr(color16, img_size.height(), img_size.width(), output_data,
-                                                      img_size.height() * img_size.width() * 10, 1024)
-
-            data0 = str(output_data).replace('\\x00', '')
-            data1 = data0[2:len(data0) - 2]
-            each_max = 1024 - 8 - 1
-            max_line = int(len(data1) / each_max)
-            append_len = each_max - 3 - int(len(data1) % each_max) + 10
-            j = 0
-            for i in range(len(output_data)):
-                if output_data[i] != 0:
-                    if j == max_line * each_max:
-                        result += '\r;' + img_type + chr(output_data[i])
-                    elif j == 0:
-                        result += img_type + chr(output_data[i])
-                    elif j % each_max == 0:
-                        result += '\r' + img_type + chr(output_data[i])
-                    else:
-                        result += chr(output_data[i])
-                    j += 1
-            result += '\r;'
-            for m in range(append_len):
-                result += '0'
+            color16: array = cls._get_rgb565_pixels(b_image)
+            img_height, img_width = img_size.height(), img_size.width()
+            output_size = img_height * img_width * 10
+            output_data = bytearray(output_size)
+            result_int = lib_col_pic.ColPic_EncodeStr(color16, img_height, img_width, output_data, output_size, 1024)
+
+            data1 = output_data.translate(None, b'\x00').decode('latin1')
+            # The line layout was originally computed on the bytearray repr, which is 10 chars longer than the data
+            # ("tearray(b'" was left over after trimming). Keep that length so the output stays identical.
+            layout_len = len(data1) + 10
+            each_max = cls.PRINTER_THUMBNAIL_LINE_SIZE
+            append_len = each_max - 3 - int(layout_len % each_max) + 10
+            result = cls._split_image_lines(data1, img_type, layout_len) + '\r;' + '0' * append_len
 
         except Exception as e:
             raise e
@@ -458,32 +489,18 @@ class ElegooNeptuneThumbnails:
     def _parse_thumbnail_b64jpg(cls, img: QImage, width: int, height: int, img_type: str) -> str:
         """
         Parse thumbnail to string for new printers
-        TODO: Maybe optimize at some time
         """
         img_type = f";{img_type}:"
 
-        result = ""
         b_image = img.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio)
 
         try:
             byte_array: QByteArray = QByteArray()
             byte_buffer: QBuffer = QBuffer(byte_array)
             byte_buffer.open(QIODeviceBase.OpenModeFlag.WriteOnly)
-            b_image.save(byte_buffer, "JPEG")
+            b_image.save(byte_buffer, "JPEG", cls.JPEG_QUALITY)
             base64_string: str = str(byte_array.toBase64().data(), "UTF-8")
-
-            each_max = 1024 - 8 - 1
-            max_line = int(len(base64_string) / each_max)
-
-            for i in range(len(base64_string)):
-                if i == max_line * each_max:
-                    result += '\r;' + img_type + base64_string[i]
-                elif i == 0:
-                    result += img_type + base64_string[i]
-                elif i % each_max == 0:
-                    result += '\r' + img_type + base64_string[i]
-                else:
-                    result += base64_string[i]
+            result = cls._split_image_lines(base64_string, img_type)
 
         except Exception as e:
             raise e
@@ -104,8 +104,7 @@ def ColPicEncode(fromcolor16, picw, pich, outputdata: bytearray, outputmaxtsize,
 
         ListQty = ListQty - 1
 
-    for n in range(len(outputdata)):
-        outputdata[n] = 0
+    outputdata[:] = bytes(len(outputdata))
 
     Head0.encodever = 3
     Head0.oncelistqty = 0